@@ -1,7 +1,14 @@
 # apgujeong_rank_app.py
 # 실행: streamlit run apgujeong_rank_app.py
 import streamlit as st
+import functools
+import hashlib
+import io
+import logging
+import queue
 import re
+import threading
+import time
 from pathlib import Path
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime, timezone, timedelta
@@ -9,6 +16,11 @@ from datetime import datetime, timezone, timedelta
 import numpy as np
 import pandas as pd
 
+# 슬라이스는 복사 없이 공유하고 수정할 때만 복사(Copy-on-Write). pandas 3부터는 항상 켜져 있음
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+logger = logging.getLogger(__name__)
 
 # zoneinfo (Py3.9+)
 try:
@@ -16,6 +28,13 @@ try:
 except Exception:
     ZoneInfo = None
 
+# python-calamine(Rust xlsx 파서)이 있으면 openpyxl 대신 사용
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except Exception:
+    EXCEL_ENGINE = None
+
 # ===== 페이지 설정 =====
 st.set_page_config(
     page_title="압구정 예비권리가액 알고사기",
@@ -46,12 +65,18 @@ PROMO_TEXT_HTML = """
 # 기본 Google Sheet (외부 공개 필요: '링크가 있는 모든 사용자 보기')
 DEFAULT_SHEET_URL = (
     "https://docs.google.com/spreadsheets/d/1E_GAGLS7PgXFUvPiz2qsZYizKfi1mCrwez2u30OBCvI/"
-    "export?format=xlsx&gid=1484463303"
+    "export?format=csv&gid=1484463303"  # CSV 내보내기: xlsx보다 전송량이 작고 C 파서로 바로 읽힘
 )
 
 # 동점 판정 정밀도(None이면 원값 기준)
 ROUND_DECIMALS = 6
 
+# 유사 금액 TOP10 집계에 쓰는 최근접 후보 세대 수
+SIMILAR_POOL_SIZE = 1000
+
+# 사용 로그를 모아서 구글 시트로 보내는 주기(초)
+USAGE_FLUSH_SEC = 2.0
+
 # ===== CSS(반응형·폰트/폭·프로모) =====
 st.markdown(
     """
@@ -100,79 +125,110 @@ table td, table th { word-break: keep-all; }
 
 
 # ===== KST 시간 헬퍼 =====
+# 시간대 객체는 한 번만 만들어 둠. zoneinfo(tzdata) 실패시 +09:00 고정 오프셋으로 대체.
+try:
+    _KST = ZoneInfo("Asia/Seoul") if ZoneInfo else timezone(timedelta(hours=9))
+except Exception:
+    _KST = timezone(timedelta(hours=9))
+
 def now_kst() -> datetime:
-    """한국 표준시(Asia/Seoul) 현재 시간. zoneinfo 실패시 +09:00 고정 오프셋으로 대체."""
-    try:
-        if ZoneInfo:
-            return datetime.now(timezone.utc).astimezone(ZoneInfo("Asia/Seoul"))
-    except Exception:
-        pass
-    return datetime.utcnow().replace(tzinfo=timezone.utc).astimezone(
-        timezone(timedelta(hours=9))
-    )
+    """한국 표준시(Asia/Seoul) 현재 시간."""
+    return datetime.now(_KST)
 
 # ===== 작은 유틸 =====
+# 자주 쓰는 정규식은 모듈 로드 시 한 번만 컴파일
+_SHEET_ID_RE = re.compile(r"/spreadsheets/d/([^/]+)/")
+_NUM_RE = re.compile(r"\d+")
+_NON_DIGIT_RE = re.compile(r"\D+")
+
 def normalize_gsheet_url(url: str) -> str:
-    """edit 링크 → export 링크로 변환"""
+    """edit 링크 → CSV export 링크로 변환 (gid가 없으면 첫 시트)"""
     if not isinstance(url, str):
         return url
     if "docs.google.com/spreadsheets" in url and "/export" not in url:
-        m = re.search(r"/spreadsheets/d/([^/]+)/", url)
+        m = _SHEET_ID_RE.search(url)
         gid = parse_qs(urlparse(url).query).get("gid", [None])[0]
         if m:
             doc_id = m.group(1)
             if gid is None:
-                return f"https://docs.google.com/spreadsheets/d/{doc_id}/export?format=xlsx"
-            return f"https://docs.google.com/spreadsheets/d/{doc_id}/export?format=xlsx&gid={gid}"
+                return f"https://docs.google.com/spreadsheets/d/{doc_id}/export?format=csv"
+            return f"https://docs.google.com/spreadsheets/d/{doc_id}/export?format=csv&gid={gid}"
     return url
 
+# 숫자/소수점/음수 부호 이외의 문자(NBSP, 쉼표, `, ', 억, 공백 등)
+_PRICE_JUNK_RE = re.compile(r"[^0-9.\-]")
+
 def clean_price(series: pd.Series) -> pd.Series:
-    """문자 섞인 가격 문자열 → 숫자(float)로 정리."""
-    s = series.astype(str)
-    s = (
-        s.str.replace("\u00A0", "", regex=False)  # NBSP
-        .str.replace(",", "", regex=False)
-        .str.replace("`", "", regex=False)
-        .str.replace("'", "", regex=False)
-        .str.replace("억", "", regex=False)
-        .str.strip()
-    )
-    s = s.str.replace(r"[^0-9.\-]", "", regex=True)  # 숫자/소수점/음수만
+    """문자 섞인 가격 문자열 → 숫자(float)로 정리. 정규식 한 번으로 숫자 외 문자 제거."""
+    if pd.api.types.is_numeric_dtype(series):  # 이미 숫자 열이면 문자열 변환 없이 그대로
+        return series.astype(np.float64)
+    s = series.astype(str).str.replace(_PRICE_JUNK_RE, "", regex=True)
     return pd.to_numeric(s, errors="coerce")
 
-def extract_floor(ho) -> float:
-    """호수에서 숫자만 추출해 '층'으로 환산 (예: 702 → 7층, 1101 → 11층)"""
-    s = str(ho)
-    digits = "".join(ch for ch in s if ch.isdigit())
-    if not digits:
-        return np.nan
-    if len(digits) >= 3:
-        return float(int(digits[:-2])) if digits[:-2] else np.nan
-    elif len(digits) == 2:
-        return float(int(digits[0]))
-    else:
-        return float(int(digits))
-
-def contiguous_ranges(sorted_ints):
-    """정수 리스트(오름차순) → 연속 구간 [(s,e), ...]"""
-    ranges = []
-    start = prev = None
-    for x in sorted_ints:
-        x = int(x)
-        if start is None:
-            start = prev = x
-        elif x == prev + 1:
-            prev = x
-        else:
-            ranges.append((start, prev))
-            start = prev = x
-    if start is not None:
-        ranges.append((start, prev))
-    return ranges
+def extract_floor_vec(ho: pd.Series) -> pd.Series:
+    """호수에서 숫자만 추출해 '층'으로 환산 (예: 702 → 7층, 1101 → 11층). 행 단위 apply 없이 벡터 연산."""
+    digits = ho.astype(str).str.replace(_NON_DIGIT_RE, "", regex=True)
+    n = digits.str.len().to_numpy()
+    val = pd.to_numeric(digits, errors="coerce").to_numpy(dtype=float)
+    floor = np.where(n >= 3, val // 100, np.where(n == 2, val // 10, val))  # 숫자 없으면 NaN 유지
+    return pd.Series(floor, index=ho.index, dtype="float64")
+
+def natural_sort_key(s):
+    """문자열 속 첫 숫자 기준 정렬 키 (예: '2구역' < '10구역'). 숫자가 없으면 맨 뒤로."""
+    m = _NUM_RE.search(str(s))
+    return (int(m.group()) if m else 10 ** 9, str(s))
+
+def price_key(prices):
+    """동점 판정용 가격 키: ROUND_DECIMALS 자리까지의 고정소수점 정수(int64, 스칼라면 int).
+    float 동등 비교 오차가 없고 해시·정렬도 정수로 처리됨. ROUND_DECIMALS가 None이면 원값 그대로(NaN 제외 후 사용)."""
+    if ROUND_DECIMALS is None:
+        return prices
+    key = np.rint(np.asarray(prices, dtype=np.float64) * 10 ** ROUND_DECIMALS).astype(np.int64)
+    return key.item() if key.ndim == 0 else key
 
 def format_range(s, e):
     return f"{s}층" if s == e else f"{s}층에서 {e}층까지"
 
+def floor_ranges_by_group(df: pd.DataFrame, group_cols) -> pd.DataFrame:
+    """범주형 그룹 열별 '층 범위' 문자열과 세대수.
+    (그룹 코드, 층)으로 한 번 정렬한 뒤 그룹 경계와 층 끊김을 numpy로 같이 찾아 구간을 만듦(그룹별 반복 없음).
+    결과는 범주 순서(=groupby(observed=True) 순서)로 정렬되어 있고, groupby처럼 그룹 값이 빈(NaN) 행은 제외."""
+    codes = [df[c].cat.codes.to_numpy() for c in group_cols]
+    rows = np.flatnonzero(np.logical_and.reduce([c >= 0 for c in codes]))  # 범주 코드 -1 = 값 없음
+    if rows.size == 0:
+        return pd.DataFrame(columns=[*group_cols, "층 범위", "세대수"])
+    codes = [c[rows] for c in codes]
+    floors = df["층"].to_numpy()[rows].astype(np.int64)
+    sub = np.lexsort([floors, *codes[::-1]])  # 마지막 키가 1순위
+    order = rows[sub]  # df 기준 행 위치
+    codes = [c[sub] for c in codes]
+    floors = floors[sub]
+
+    # 그룹 시작 위치 / 그룹별 세대수(중복 층 포함)
+    new_group = np.zeros(floors.size, dtype=bool)
+    new_group[0] = True
+    for c in codes:
+        new_group[1:] |= c[1:] != c[:-1]
+    group_starts = np.flatnonzero(new_group)
+    counts = np.diff(np.r_[group_starts, floors.size])
+
+    # 같은 그룹 안의 중복 층 제거 후, 그룹이 바뀌거나 층이 1 넘게 뛰면 새 구간
+    keep = new_group | np.r_[True, floors[1:] != floors[:-1]]
+    f, g = floors[keep], new_group[keep]
+    run_start = g | np.r_[True, np.diff(f) != 1]
+    starts = np.flatnonzero(run_start)
+    ends = np.r_[starts[1:] - 1, f.size - 1]
+    run_strs = [format_range(s, e) for s, e in zip(f[starts].tolist(), f[ends].tolist())]
+
+    # 구간 → 그룹별로 이어 붙이기 (구간이 그룹 순으로 정렬되어 있으므로 경계에서 자르기만 하면 됨)
+    cuts = np.flatnonzero(g[starts])[1:]
+    ranges = [", ".join(part) for part in np.split(np.array(run_strs, dtype=object), cuts)]
+
+    out = df.iloc[order[group_starts]][list(group_cols)].reset_index(drop=True)
+    out["층 범위"] = ranges
+    out["세대수"] = counts
+    return out
+
 def detect_device_from_toggle() -> str:
     """모바일 간단 보기 토글 기준으로 device 기록"""
     return "mobile" if st.session_state.get("mobile_simple", False) else "desktop"
@@ -182,24 +238,15 @@ def show_promo():
     st.markdown(PROMO_TEXT_HTML, unsafe_allow_html=True)
     st.write("")  # 겹침 방지용 여백
 
-# ===== 데이터 로딩 =====
-def load_data(source):
-    """URL이면 read_excel/CSV, 로컬이면 read_excel → 표준화 후 환산감정가 생성(공시가÷0.69, fallback: 감정가(억))."""
-    is_url = isinstance(source, str) and (source.startswith("http://") or source.startswith("https://"))
-    with st.spinner("데이터 불러오는 중…"):
-        if is_url:
-            parsed = urlparse(source)
-            fmt = (parse_qs(parsed.query).get("format", [None])[0] or "").lower()
-            if fmt == "csv":
-                df = pd.read_csv(source)
-            else:
-                df = pd.read_excel(source, sheet_name=0)
-        else:
-            p = Path(source)
-            if not p.exists():
-                raise FileNotFoundError(f"경로가 존재하지 않습니다: {p}")
-            df = pd.read_excel(p, sheet_name=0)
+@st.cache_data(max_entries=32, show_spinner=False)
+def _to_csv_bytes(df: pd.DataFrame) -> bytes:
+    """다운로드용 CSV(엑셀 호환 utf-8-sig). 같은 표 내용이면 재실행 시 인코딩 결과 재사용."""
+    return df.to_csv(index=False).encode("utf-8-sig")
 
+# ===== 데이터 로딩 =====
+def _standardize(df: pd.DataFrame):
+    """열 이름 표준화 후 환산감정가 생성(공시가÷0.69, fallback: 감정가(억)).
+    (df, ({구역: 행 위치}, {(구역, 동): 행 위치})) 반환 — 행 위치는 이 df 기준이라 항상 같이 다님."""
     # 열 이름 표준화(필수: 구역·동·호·공시가(억) / 선택: 감정가(억), 평형)
     rename_map = {
         "구역": "구역",
@@ -216,48 +263,252 @@ def load_data(source):
         if c in df.columns:
             df[c] = df[c].astype(str).str.strip()
 
+    # 층은 호에서 한 번만 계산해 두고 이후 구간 요약에서 재사용
+    df["층"] = extract_floor_vec(df["호"]) if "호" in df.columns else np.nan
+
     # 25년 공시가가 따로 있으면 우선 사용, 없으면 '공시가(억)' 사용
     if "25년 공시가(억)" in df.columns:
         public = clean_price(df["25년 공시가(억)"])
     else:
-        public = clean_price(df.get("공시가(억)", pd.Series(dtype=object)))
+        public = clean_price(df.get("공시가(억)", pd.Series(np.nan, index=df.index)))
 
-    # 환산감정가 = 공시가(억) ÷ 0.69 (fallback: 감정가(억) 클린)
+    # 환산감정가 = 공시가(억) ÷ 0.69 (fallback: 감정가(억) 클린 — 공시가가 빈 행이 있을 때만 계산)
     derived = public / 0.69
-    fallback = clean_price(df.get("감정가(억)", pd.Series(dtype=object)))
-    df["환산감정가_억"] = derived.where(~derived.isna(), fallback)
+    if "감정가(억)" in df.columns and derived.isna().any():
+        derived = derived.where(derived.notna(), clean_price(df["감정가(억)"]))
+    # 로딩 시 float64로 확정 → 이후 구간에서 pd.to_numeric 재검증 불필요
+    df["환산감정가_억"] = derived.astype(np.float64)
 
     # 평형이 없다면 빈칸
     if "평형" not in df.columns:
         df["평형"] = ""
 
-    return df
+    # 구역/동/평형은 같은 값이 반복되는 열 → category(숫자 기준으로 정렬된 범주)
+    for c in ["구역", "동", "평형"]:
+        if c in df.columns:
+            cats = sorted(df[c].dropna().unique().tolist(), key=natural_sort_key)
+            df[c] = pd.Categorical(df[c], categories=cats, ordered=True)
+
+    # 내용 기반 데이터 버전: 하위 캐시 함수들이 매 rerun마다 DataFrame 전체를 해시하지 않도록 키로 사용.
+    # 행 해시를 순서대로 이어 붙여 다이제스트 → 같은 행이라도 순서가 바뀌면 다른 버전(행 위치 캐시 보호)
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    df.attrs["data_version"] = hashlib.blake2b(row_hashes.tobytes()).hexdigest()
+
+    # 선택 시 전체 행 마스크 대신 iloc로 바로 자르기 위한 행 위치. 같은 캐시 값으로 묶어 df와 어긋나지 않게 함
+    if "구역" in df.columns and "동" in df.columns:
+        row_pos = (
+            df.groupby("구역", observed=True, sort=False).indices,
+            df.groupby(["구역", "동"], observed=True, sort=False).indices,
+        )
+    else:
+        row_pos = ({}, {})
+    return df, row_pos
 
-# ===== 구글시트 로깅 =====
-def append_usage_row(date_str, time_str, device, zone, dong, ho):
-    """구글 시트에 간소화된 사용 로그 기록 (sheet1 사용)"""
-    if "gcp_service_account" not in st.secrets or not st.secrets.get("USAGE_SHEET_ID"):
-        return False, "시크릿에 서비스 계정/시트 ID가 없습니다."
+# 키 열은 문자열로 읽음 (빈칸이 섞여도 101 → "101.0"처럼 float로 바뀌지 않도록)
+KEY_DTYPES = {"구역": str, "동": str, "호": str}
+
+def _read_excel(src) -> pd.DataFrame:
+    """엑셀 첫 시트 읽기 (EXCEL_ENGINE: calamine 또는 pandas 기본)."""
+    return pd.read_excel(src, sheet_name=0, engine=EXCEL_ENGINE, dtype=KEY_DTYPES)
+
+# URL 요청 헤더: CSV는 gzip 전송을 요청(pandas가 Content-Encoding: gzip 응답을 알아서 풀어 줌)
+HTTP_HEADERS = {"Accept-Encoding": "gzip"}
+
+def _read_csv(src, storage_options=None) -> pd.DataFrame:
+    """CSV 읽기: pyarrow 엔진(멀티스레드) 우선, 안 되면 pandas C 엔진으로 대체."""
     try:
-        import gspread
-        from google.oauth2.service_account import Credentials
-
-        sa_info = st.secrets["gcp_service_account"]
-        creds = Credentials.from_service_account_info(
-            sa_info,
-            scopes=[
-                "https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive",
+        return pd.read_csv(src, dtype=KEY_DTYPES, engine="pyarrow", storage_options=storage_options)
+    except (ImportError, ValueError):
+        return pd.read_csv(src, dtype=KEY_DTYPES, low_memory=False, storage_options=storage_options)
+
+@st.cache_data(ttl=3600, max_entries=16, show_spinner="데이터 불러오는 중…")
+def load_data(source: str):
+    """URL이면 read_excel/CSV, 로컬이면 read_excel → 표준화(df, 행 위치). 소스 문자열 기준으로 1시간 캐시."""
+    is_url = source.startswith("http://") or source.startswith("https://")
+    if is_url:
+        parsed = urlparse(source)
+        fmt = (parse_qs(parsed.query).get("format", [None])[0] or "").lower()
+        if fmt == "csv":
+            df = _read_csv(source, storage_options=HTTP_HEADERS)
+        else:
+            df = _read_excel(source)
+    else:
+        p = Path(source)
+        if not p.exists():
+            raise FileNotFoundError(f"경로가 존재하지 않습니다: {p}")
+        df = _read_excel(p)
+    return _standardize(df)
+
+@st.cache_data(ttl=3600, max_entries=8, show_spinner="데이터 불러오는 중…")
+def _load_from_bytes(data: bytes):
+    """업로드된 엑셀 파일 내용(bytes) → 표준화(df, 행 위치). 파일 내용 기준으로 캐시."""
+    return _standardize(_read_excel(io.BytesIO(data)))
+
+# ===== 선택 목록 =====
+# 아래 파생 표들은 읽기 전용이라 cache_resource로 객체를 그대로 공유(cache_data처럼 hit마다 역직렬화하지 않음).
+# 데이터 버전별로 쌓이지 않도록 load_data와 같은 ttl에 max_entries로 상한을 둠. 반환값은 수정하지 말 것.
+@st.cache_resource(ttl=3600, max_entries=8, show_spinner=False)
+def _selector_trees(data_version: str, _df: pd.DataFrame):
+    """선택 UI용 (구역 목록, {구역: 동 목록}, {(구역, 동): 호 목록})을 한 번에 구성. 모두 숫자 기준 정렬.
+    캐시 키는 data_version(_df는 해시하지 않음)."""
+    df = _df
+    zones = df["구역"].cat.categories.tolist()
+    dongs_by_zone, hos_by_dong = {}, {}
+    for (zone_name, dong_name), g in df.groupby(["구역", "동"], observed=True):
+        dongs_by_zone.setdefault(zone_name, []).append(dong_name)
+        hos_by_dong[(zone_name, dong_name)] = sorted(g["호"].dropna().unique().tolist(), key=natural_sort_key)
+    return zones, dongs_by_zone, hos_by_dong
+
+# ===== 순위 계산(경쟁 순위) =====
+@st.cache_resource(ttl=3600, max_entries=8, show_spinner=False)
+def _rank_all_zones(data_version: str, _df: pd.DataFrame):
+    """구역별 경쟁 순위 표 {구역: work}와 {구역: {가격키: (순위, 공동세대수)}} 조회표를 한 번에 계산.
+    같은 데이터(data_version)면 재실행 시 캐시 재사용(읽기 전용 공유 객체)."""
+    df = _df
+    ranked, rank_lookup = {}, {}
+    for zone_name, zone_df in df.groupby("구역", observed=True, sort=False):
+        work = zone_df.dropna(subset=["환산감정가_억"])  # CoW: 열 추가 시 원본과 분리됨
+
+        # 동점 키(라운딩 or 원값) + 경쟁 순위
+        prices = work["환산감정가_억"].to_numpy(dtype=np.float64, copy=False)
+        work["가격키"] = price_key(prices)
+        # np.unique(오름차순) 한 번으로 키별 세대수를 얻고, 내림차순 min 순위 = (더 큰 키 세대수) + 1
+        uniq, inv, counts = np.unique(work["가격키"].to_numpy(), return_inverse=True, return_counts=True)
+        key_rank = len(work) - np.cumsum(counts) + 1
+        work["순위"] = key_rank[inv]
+        work["공동세대수"] = counts[inv].astype(np.int32)
+        ranked[zone_name] = work.sort_values(
+            ["가격키", "동", "호"], ascending=[False, True, True]
+        ).reset_index(drop=True)
+        # 같은 가격키는 순위·공동세대수가 같으므로 키당 한 번만 저장
+        rank_lookup[zone_name] = dict(zip(uniq.tolist(), zip(key_rank.tolist(), counts.tolist())))
+    return ranked, rank_lookup
+
+# ===== 유사 금액 TOP10 =====
+@st.cache_data(max_entries=256, show_spinner=False)
+def _similar_top10(data_version: str, _df: pd.DataFrame, self_pos: tuple, sel_price: float) -> pd.DataFrame:
+    """전 구역에서 선택 세대(self_pos 행 위치)를 뺀 뒤 금액이 가까운 후보를 (구역, 동, 평형)별로 묶은 상위 10개 표.
+    결과가 선택 값에만 의존하므로 (data_version, 선택 행, 금액) 기준으로 캐시."""
+    df = _df
+    # 전 구역에서 환산감정가 유효 + 선택 세대 자체는 제외 (DataFrame 복사 없이 numpy 배열로 계산)
+    prices = df["환산감정가_억"].to_numpy()
+    in_pool = ~np.isnan(prices)
+    in_pool[list(self_pos)] = False  # 선택 세대 행 위치만 직접 제외(전체 비교 없음)
+    pool_idx = np.flatnonzero(in_pool)
+    dist = np.abs(prices[pool_idx] - sel_price)  # 유사도(절대 차이)
+
+    # 유사도 상위 K개만 확보: 전체 정렬 대신 argpartition 계열(O(n))로 K번째 값을 찾고 그 이하만 정렬
+    k = min(SIMILAR_POOL_SIZE, pool_idx.size)
+    if k < pool_idx.size:
+        near = dist <= np.partition(dist, k - 1)[k - 1]  # 경계 동점까지 포함 후 아래에서 K개로 자름
+        pool_idx, dist = pool_idx[near], dist[near]
+    order = np.lexsort((pool_idx, -prices[pool_idx], dist))[:k]  # 유사도↑, 금액↓, 원래 행 순서
+    cand = df.iloc[pool_idx[order]][["구역", "동", "평형", "환산감정가_억", "층"]]
+
+    # (구역, 동, 평형)별 세대수·중앙값을 한 번에 집계 → 정렬 후 상위 10개 그룹만 층 범위 계산
+    group_cols = ["구역", "동", "평형"]
+    cand = cand.dropna(subset=["층"])
+    agg = (
+        cand.groupby(group_cols, observed=True, sort=False)  # 정렬은 아래에서 범주 코드로 한 번만
+        .agg(세대수=("층", "size"), 중앙값=("환산감정가_억", "median"))
+        .reset_index()
+    )
+    # 범주가 이미 숫자 기준으로 정렬되어 있으므로 범주 코드가 곧 구역/동/평형 정렬 키
+    agg["_sz"] = agg["구역"].cat.codes
+    agg["_sd"] = agg["동"].cat.codes
+    agg["_sp"] = agg["평형"].cat.codes
+    top = agg.sort_values(["_sz", "_sd", "세대수", "_sp"], ascending=[True, True, False, True]).head(10)
+
+    top_keys = pd.MultiIndex.from_frame(top[group_cols])
+    in_top = pd.MultiIndex.from_frame(cand[group_cols]).isin(top_keys)
+    top_ranges = floor_ranges_by_group(cand[in_top], group_cols)
+    ranges_by_key = dict(zip(zip(*(top_ranges[c] for c in group_cols)), top_ranges["층 범위"]))
+
+    return pd.DataFrame(
+        {
+            "구역": top["구역"].tolist(),
+            "동(평형)": [
+                f"{dong_name}동({pyeong})" if str(pyeong) else f"{dong_name}동"
+                for dong_name, pyeong in zip(top["동"], top["평형"])
             ],
-        )
-        gc = gspread.authorize(creds)
-        sh = gc.open_by_key(st.secrets["USAGE_SHEET_ID"])
-        ws = sh.sheet1  # 첫 번째 시트 사용
-        row = [date_str, time_str, device, zone, dong, ho]
-        ws.append_row(row, value_input_option="RAW")
-        return True, "ok"
+            "층 범위": [ranges_by_key[key] for key in top_keys],
+            "세대수": top["세대수"].astype(int).tolist(),
+            "중앙값 환산감정가(억)": [round(float(m), 2) for m in top["중앙값"]],
+        }
+    )
+
+# ===== 구글시트 로깅 =====
+def _usage_settings():
+    """시크릿의 (서비스 계정 정보, 로그 시트 ID). 설정이 없거나 secrets.toml 자체가 없으면 None."""
+    try:
+        if "gcp_service_account" in st.secrets and st.secrets.get("USAGE_SHEET_ID"):
+            return dict(st.secrets["gcp_service_account"]), st.secrets["USAGE_SHEET_ID"]
+    except Exception:  # secrets.toml이 없으면 접근 자체가 예외
+        pass
+    return None
+
+_USAGE_SETTINGS = _usage_settings()
+_USAGE_ENABLED = _USAGE_SETTINGS is not None
+
+@functools.lru_cache(maxsize=1)
+def _usage_deps():
+    """gspread/google-auth는 로깅을 쓸 때만 필요하므로 처음 호출 시 한 번만 import."""
+    import gspread
+    from google.oauth2.service_account import Credentials
+    return gspread, Credentials
+
+def _open_usage_ws(sa_info: dict, sheet_id: str):
+    """서비스 계정 인증 → 로그 시트(sheet1) 핸들."""
+    gspread, Credentials = _usage_deps()
+    creds = Credentials.from_service_account_info(
+        sa_info,
+        scopes=[
+            "https://www.googleapis.com/auth/spreadsheets",
+            "https://www.googleapis.com/auth/drive",
+        ],
+    )
+    gc = gspread.authorize(creds)
+    sh = gc.open_by_key(sheet_id)
+    return sh.sheet1  # 첫 번째 시트 사용
+
+def _usage_log_worker(log_q: queue.Queue, sa_info: dict, sheet_id: str):
+    """(백그라운드 데몬) 큐에 쌓인 로그 행을 모아 append_rows 한 번으로 sheet1에 기록.
+    워커는 프로세스당 하나이므로 인증된 시트 핸들(HTTP 세션)을 계속 재사용하고, 실패하면 다음 묶음에서 다시 연결."""
+    ws = None
+    try:
+        _usage_deps()  # 첫 행을 기다리는 동안 import 비용을 미리 치름
     except Exception as e:
-        return False, str(e)
+        logger.warning("gspread/google-auth import 실패: %s", e)
+    while True:
+        rows = [log_q.get()]  # 첫 행이 들어올 때까지 대기
+        time.sleep(USAGE_FLUSH_SEC)  # 그 사이 들어온 행까지 묶어서 전송
+        while True:
+            try:
+                rows.append(log_q.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            if ws is None:
+                ws = _open_usage_ws(sa_info, sheet_id)
+            ws.append_rows(rows, value_input_option="RAW")
+        except Exception as e:
+            ws = None
+            logger.warning("사용 로그 %d건 기록 실패: %s", len(rows), e)
+
+@st.cache_resource(show_spinner=False)
+def _usage_log_queue(sa_info: dict, sheet_id: str) -> queue.Queue:
+    """프로세스당 하나의 로그 큐와 이를 비우는 데몬 스레드."""
+    log_q = queue.Queue()
+    threading.Thread(target=_usage_log_worker, args=(log_q, sa_info, sheet_id), daemon=True).start()
+    return log_q
+
+def append_usage_row(date_str, time_str, device, zone, dong, ho):
+    """구글 시트에 간소화된 사용 로그 기록 (sheet1 사용). 큐에 넣기만 하고 전송은 백그라운드에서 묶어서 처리."""
+    if not _USAGE_ENABLED:
+        return False, "시크릿에 서비스 계정/시트 ID가 없습니다."
+    log_q = _usage_log_queue(*_USAGE_SETTINGS)
+    log_q.put([date_str, time_str, device, zone, dong, ho])
+    return True, "ok"
 
 # ===== 상단 UI =====
 st.title("🏢 압구정 예비권리가액 알고사기")
@@ -268,6 +519,7 @@ with top_left:
     st.toggle("📱 모바일 간단 보기", key="mobile_simple", value=True, help="모바일에서 보기 편한 간단 레이아웃")
 with top_right:
     if st.button("🔄 데이터 새로고침"):
+        st.cache_data.clear()  # 캐시된 데이터를 버리고 원본에서 다시 읽음
         st.rerun()
 
 with st.expander("① 데이터 파일/URL 선택 — 필요한 열: ['구역','동','호','공시가(억)'/'25년 공시가(억)','감정가(억)','평형']", expanded=False):
@@ -292,16 +544,16 @@ with st.expander("① 데이터 파일/URL 선택 — 필요한 열: ['구역','
 # ===== 데이터 로딩 =====
 try:
     if isinstance(resolved_source, str):
-        df = load_data(resolved_source)
+        df, (zone_rows, dong_rows) = load_data(resolved_source)
     else:
-        df = load_data(resolved_source)  # 업로드 파일 객체도 동일 처리
+        df, (zone_rows, dong_rows) = _load_from_bytes(resolved_source.getvalue())  # 업로드 파일은 내용(bytes) 기준 캐시
     st.success("데이터 로딩 완료")
 except Exception as e:
     st.error(f"데이터를 불러오지 못했습니다: {e}")
     st.stop()
 
 # ===== 선택 UI =====
-zones = sorted(df["구역"].dropna().unique().tolist()) if "구역" in df.columns else []
+zones, dongs_by_zone, hos_by_dong = _selector_trees(df.attrs["data_version"], df) if "구역" in df.columns else ([], {}, {})
 if not zones:
     st.warning("구역 데이터가 비어 있습니다.")
     st.stop()
@@ -309,28 +561,28 @@ if not zones:
 # 모바일/데스크탑 레이아웃 분기
 if st.session_state.get("mobile_simple", False):
     zone = st.selectbox("구역 선택", zones, index=0)
-    zone_df = df[df["구역"] == zone].copy()
+    zone_df = df.iloc[zone_rows[zone]]
 
-    dongs = sorted(zone_df["동"].dropna().unique().tolist())
+    dongs = dongs_by_zone.get(zone, [])
     dong = st.selectbox("동 선택", dongs, index=0 if dongs else None)
 
-    dong_df = zone_df[zone_df["동"] == dong].copy()
-    hos = sorted(dong_df["호"].dropna().unique().tolist())
+    dong_df = df.iloc[dong_rows.get((zone, dong), [])]
+    hos = hos_by_dong.get((zone, dong), [])
     ho = st.selectbox("호 선택", hos, index=0 if hos else None)
 else:
     c1, c2, c3 = st.columns(3)
     with c1:
         zone = st.selectbox("구역 선택", zones, index=0)
-    zone_df = df[df["구역"] == zone].copy()
+    zone_df = df.iloc[zone_rows[zone]]
     with c2:
-        dongs = sorted(zone_df["동"].dropna().unique().tolist())
+        dongs = dongs_by_zone.get(zone, [])
         dong = st.selectbox("동 선택", dongs, index=0 if dongs else None)
-    dong_df = zone_df[zone_df["동"] == dong].copy()
+    dong_df = df.iloc[dong_rows.get((zone, dong), [])]
     with c3:
-        hos = sorted(dong_df["호"].dropna().unique().tolist())
+        hos = hos_by_dong.get((zone, dong), [])
         ho = st.selectbox("호 선택", hos, index=0 if hos else None)
 
-sel_df = dong_df[dong_df["호"] == ho].copy()
+sel_df = dong_df[dong_df["호"] == ho]
 if sel_df.empty:
     st.warning("선택한 동/호 데이터가 없습니다.")
     st.stop()
@@ -347,31 +599,18 @@ if not go:
 # ===== 순위 계산(경쟁 순위) =====
 total_units_all = len(zone_df)
 
-work = zone_df.dropna(subset=["환산감정가_억"]).copy()
-work = work[pd.to_numeric(work["환산감정가_억"], errors="coerce").notna()].copy()
-work["환산감정가_억"] = work["환산감정가_억"].astype(float)
+zone_ranks, zone_rank_lookup = _rank_all_zones(df.attrs["data_version"], df)
+work = zone_ranks[zone]
 
-bad_mask = pd.to_numeric(zone_df["환산감정가_억"], errors="coerce").isna()
-bad_rows = zone_df[bad_mask].copy()
-
-# 동점 키(라운딩 or 원값) + 경쟁 순위
-work["가격키"] = (
-    work["환산감정가_억"].round(ROUND_DECIMALS)
-    if ROUND_DECIMALS is not None
-    else work["환산감정가_억"]
-)
-work["순위"] = work["가격키"].rank(method="min", ascending=False).astype(int)
-work["공동세대수"] = work.groupby("가격키")["가격키"].transform("size")
-work = work.sort_values(["가격키", "동", "호"], ascending=[False, True, True]).reset_index(drop=True)
+bad_mask = zone_df["환산감정가_억"].isna()
+bad_rows = zone_df[bad_mask]
 
 # 선택 세대의 가격/키/순위
 sel_price = float(sel_df.iloc[0]["환산감정가_억"]) if pd.notna(sel_df.iloc[0]["환산감정가_억"]) else np.nan
-sel_key = round(sel_price, ROUND_DECIMALS) if (pd.notna(sel_price) and ROUND_DECIMALS is not None) else sel_price
+sel_key = price_key(sel_price) if pd.notna(sel_price) else np.nan
 
 if pd.notna(sel_key):
-    subset = work[work["가격키"] == sel_key]
-    sel_rank = int(subset["순위"].min()) if not subset.empty else None
-    sel_tied = int(subset["공동세대수"].max()) if not subset.empty else 0
+    sel_rank, sel_tied = zone_rank_lookup[zone].get(sel_key, (None, 0))  # 행 스캔 없이 dict 조회
 else:
     sel_rank, sel_tied = None, 0
 
@@ -405,32 +644,21 @@ if "25년 공시가(억)" in sel_df.columns:
 else:
     public_one = clean_price(sel_df.get("공시가(억)", pd.Series([np.nan]))).iloc[0]
 
+# 한 행짜리 정적 표라 st.table로 그리고, 숫자 서식은 여기서 한 번만 적용
 row_show = pd.DataFrame(
     [{
         "구역": zone,
         "동": dong,
         "호": ho,
         "평형": str(sel_df["평형"].iloc[0]) if "평형" in sel_df.columns else "",
-        "25년 공시가(억)": round(public_one, 2) if pd.notna(public_one) else np.nan,
-        "환산감정가(억)": round(sel_price, 2) if pd.notna(sel_price) else np.nan,
-        "순위": sel_rank if sel_rank is not None else "",
-        "공동세대수": sel_tied if sel_tied else "",
+        "25년 공시가(억)": f"{public_one:,.2f}" if pd.notna(public_one) else "-",
+        "환산감정가(억)": f"{sel_price:,.2f}" if pd.notna(sel_price) else "-",
+        "순위": str(sel_rank) if sel_rank is not None else "",
+        "공동세대수": str(sel_tied) if sel_tied else "",
     }]
 )
 
-st.dataframe(
-    row_show,
-    use_container_width=True,
-    column_config={
-        "동": st.column_config.TextColumn(width="small"),
-        "평형": st.column_config.TextColumn(width="small"),
-        "25년 공시가(억)": st.column_config.NumberColumn(format="%.2f", width="medium"),
-        "환산감정가(억)": st.column_config.NumberColumn(format="%.2f", width="medium"),
-        "순위": st.column_config.NumberColumn(width="small"),
-        "공동세대수": st.column_config.NumberColumn(width="small"),
-    },
-    hide_index=True,
-)
+st.table(row_show)
 
 # === 프로모 카드(모바일/PC 공통, 항상 표 아래) ===
 show_promo()
@@ -442,42 +670,33 @@ st.subheader("공동순위 요약 (선택 세대 금액 기준)")
 if sel_rank is None or pd.isna(sel_key):
     st.info("선택 세대의 환산감정가가 유효하지 않아 공동순위를 계산할 수 없습니다.")
 else:
-    tmp = work.copy()
-    tmp["층"] = tmp["호"].apply(extract_floor)
-    grp = tmp[tmp["가격키"] == sel_key].copy()
+    grp = work[work["가격키"] == sel_key]
 
     # 헤더
-    st.markdown(f"**공동 {sel_rank}위 ({sel_tied}세대)** · 환산감정가: **{sel_key:,.2f}억**")
+    st.markdown(f"**공동 {sel_rank}위 ({sel_tied}세대)** · 환산감정가: **{sel_price:,.2f}억**")
 
     no_floor = grp["층"].isna().sum()
     if no_floor > 0:
         st.caption(f"※ 층 정보가 없는 세대 {no_floor}건은 범위 요약에서 제외됩니다.")
 
-    rows = []
-    for (dong_name, pyeong), g in grp.dropna(subset=["층"]).groupby(["동", "평형"]):
-        floors = sorted(set(int(x) for x in g["층"].dropna().tolist()))
-        if not floors:
-            continue
-        ranges = contiguous_ranges(floors)
-        ranges_str = ", ".join(format_range(s, e) for s, e in ranges)
-        rows.append(
-            {"동(평형)": f"{dong_name}동({pyeong})" if str(pyeong) else f"{dong_name}동", "층 범위": ranges_str, "세대수": len(g)}
-        )
-
-    # 동명 숫자 기준 정렬
-    def _dong_num(s):
-        m = re.search(r"\d+", str(s))
-        return int(m.group()) if m else 10 ** 9
-
-    rows = sorted(rows, key=lambda r: _dong_num(r["동(평형)"]))
+    # 동/평형 범주가 숫자 기준으로 정렬되어 있어 범주 코드 순서가 곧 동명 숫자 순서
+    summary = floor_ranges_by_group(grp.dropna(subset=["층"]), ["동", "평형"])
 
-    if rows:
-        out = pd.DataFrame(rows)
+    if not summary.empty:
+        out = pd.DataFrame(
+            {
+                "동(평형)": [
+                    f"{dong_name}동({pyeong})" if str(pyeong) else f"{dong_name}동"
+                    for dong_name, pyeong in zip(summary["동"], summary["평형"])
+                ],
+                "층 범위": summary["층 범위"],
+                "세대수": summary["세대수"],
+            }
+        )
         st.dataframe(out, use_container_width=True, hide_index=True)
-        csv_agg = out.to_csv(index=False).encode("utf-8-sig")
         st.download_button(
             "현재 공동순위 요약 CSV 다운로드",
-            csv_agg,
+            _to_csv_bytes(out),
             file_name=f"{zone}_공동{sel_rank}위_동평형층요약.csv",
             mime="text/csv",
         )
@@ -493,56 +712,13 @@ st.caption("※ 공시가격에 기반한 것으로 실제 시장 상황과 다
 if pd.isna(sel_price):
     st.info("선택 세대의 환산감정가가 유효하지 않아 유사 금액을 찾을 수 없습니다.")
 else:
-    # 전 구역에서 환산감정가 유효 + 층 정보 계산
-    pool = df.copy()
-    pool = pool[pd.to_numeric(pool["환산감정가_억"], errors="coerce").notna()].copy()
-    pool["환산감정가_억"] = pool["환산감정가_억"].astype(float)
-    pool["층"] = pool["호"].apply(extract_floor)
-
-    # 선택 세대 자체는 제외
-    pool = pool[~((pool["구역"] == zone) & (pool["동"] == dong) & (pool["호"] == ho) &
-                  (np.isclose(pool["환산감정가_억"], sel_price, rtol=0, atol=1e-6)))].copy()
-
-    # 유사도(절대 차이) → 후보 정렬 후 상위 넉넉히 확보
-    pool["유사도"] = (pool["환산감정가_억"] - sel_price).abs()
-    cand = pool.sort_values(["유사도", "환산감정가_억"], ascending=[True, False]).head(1000).copy()
-
-    # (구역, 동, 평형)별 요약
-    def _zone_num(z):
-        m = re.search(r"\d+", str(z))
-        return int(m.group()) if m else 10 ** 9
-
-    def _dong_num(d):
-        m = re.search(r"\d+", str(d))
-        return int(m.group()) if m else 10 ** 9
-
-    rows2 = []
-    for (zone_name, dong_name, pyeong), g in cand.dropna(subset=["층"]).groupby(["구역", "동", "평형"]):
-        floors = sorted(set(int(x) for x in g["층"].dropna().tolist()))
-        if not floors:
-            continue
-        ranges = contiguous_ranges(floors)
-        ranges_str = ", ".join(format_range(s, e) for s, e in ranges)
-        median_price = float(g["환산감정가_억"].median()) if len(g) else np.nan
-        rows2.append(
-            {
-                "구역": zone_name,
-                "동(평형)": f"{dong_name}동({pyeong})" if str(pyeong) else f"{dong_name}동",
-                "층 범위": ranges_str,
-                "세대수": int(len(g)),
-                "중앙값 환산감정가(억)": round(median_price, 2) if pd.notna(median_price) else np.nan,
-                "_sz": _zone_num(zone_name),
-                "_sd": _dong_num(dong_name),
-            }
-        )
+    # 선택(구역·동·호)이 같으면 모바일 토글 등 다른 위젯 재실행에서는 캐시 결과를 그대로 사용
+    self_pos = tuple(df.index.get_indexer(sel_df.index).tolist())
+    out2 = _similar_top10(df.attrs["data_version"], df, self_pos, sel_price)
 
-    if not rows2:
+    if out2.empty:
         st.info("유사 금액 결과가 없습니다.")
     else:
-        out2 = pd.DataFrame(rows2).sort_values(
-            ["_sz", "_sd", "세대수"], ascending=[True, True, False]
-        ).head(10).drop(columns=["_sz", "_sd"])
-
         st.dataframe(
             out2,
             use_container_width=True,
@@ -553,10 +729,9 @@ else:
                 "중앙값 환산감정가(억)": st.column_config.NumberColumn(format="%.2f"),
             },
         )
-        csv_sim = out2.to_csv(index=False).encode("utf-8-sig")
         st.download_button(
             "유사금액 범위 TOP10 CSV 다운로드",
-            csv_sim,
+            _to_csv_bytes(out2),
             file_name=f"압구정_유사금액_범위_TOP10_{zone}_{dong}_{ho}.csv",
             mime="text/csv",
         )
@@ -565,12 +740,12 @@ else:
 if not bad_rows.empty:
     with st.expander("비정상 환산감정가(미기재/비정상) 행 보기 / 다운로드", expanded=False):
         cols_exist = [c for c in ["구역", "동", "호", "공시가(억)", "25년 공시가(억)", "감정가(억)", "평형"] if c in bad_rows.columns]
-        bad_show = bad_rows[["구역", "동", "호"] + cols_exist].copy().drop_duplicates()
+        bad_show = bad_rows[cols_exist].drop_duplicates()
         st.dataframe(bad_show.reset_index(drop=True), use_container_width=True)
-        bad_csv = bad_show.to_csv(index=False).encode("utf-8-sig")
+        # CSV는 다운로드 버튼을 눌렀을 때만 생성(재실행마다 인코딩하지 않음)
         st.download_button(
             "비정상 환산감정가 목록 CSV 다운로드",
-            bad_csv,
+            lambda: _to_csv_bytes(bad_show),
             file_name=f"{zone}_비정상_환산감정가_목록.csv",
             mime="text/csv",
         )
@@ -579,9 +754,7 @@ if not bad_rows.empty:
 if go:
     device = detect_device_from_toggle()
     # ✅ 한국 시간으로 기록
-    now = now_kst()
-    date_str = now.strftime("%Y-%m-%d")
-    time_str = now.strftime("%H:%M")
+    date_str, time_str = now_kst().strftime("%Y-%m-%d\t%H:%M").split("\t")
 
     ok, msg = append_usage_row(date_str, time_str, device, str(zone), str(dong), str(ho))
     if ok: